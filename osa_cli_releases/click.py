@@ -1,4 +1,6 @@
 import click
+from dulwich.errors import NotGitRepository  # dulwich
+import osa_cli_releases.daemon as daemon
 import osa_cli_releases.releasing as releasing
 
 
@@ -8,6 +10,19 @@ def releases():
     pass
 
 
+def run_in_daemon(command, **kwargs):
+    """ Runs the command in the daemon, when one is running
+    :returns: True if the daemon ran the command, False otherwise
+    """
+    if not daemon.is_running():
+        return False
+    response = daemon.send_request(command, **kwargs)
+    click.echo(response["output"], nl=False)
+    if response["error"]:
+        raise click.ClickException(response["error"])
+    return True
+
+
 @releases.command("check_pins")
 @click.pass_obj
 @click.option(
@@ -49,11 +64,19 @@ def analyse_global_requirement_pins(global_ctx, **kwargs):
     help="path to the folder containing YAML files to update with new SHAs",
     default="playbooks/defaults/repo_packages/",
 )
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="patch the SHA lines in place instead of reloading the whole YAML files",
+)
 def bump_upstream_repos_shas(global_ctx, **kwargs):
     """ Bump upstream projects SHAs.
     :param path: String containing the path of the YAML files formatted for updates
     """
-    releasing.bump_upstream_repos_shas(kwargs["path"])
+    if not run_in_daemon(
+        "bump_upstream_shas", path=kwargs["path"], stream=kwargs["stream"]
+    ):
+        releasing.bump_upstream_repos_shas(kwargs["path"], stream=kwargs["stream"])
 
 
 @releases.command("bump_roles")
@@ -69,9 +92,12 @@ def bump_arr(global_ctx, **kwargs):
     """ Bump roles SHA and copies their releases notes.
     Also bumps roles from external sources when the branch to bump is master.
     """
-    releasing.update_ansible_role_requirements_file(
-        filename=kwargs["file"], branchname=kwargs["os_branch"]
-    )
+    if not run_in_daemon(
+        "bump_roles", filename=kwargs["file"], branchname=kwargs["os_branch"]
+    ):
+        releasing.update_ansible_role_requirements_file(
+            filename=kwargs["file"], branchname=kwargs["os_branch"]
+        )
 
 
 @releases.command("freeze_roles_for_milestone")
@@ -86,6 +112,115 @@ def freeze_arr(global_ctx, **kwargs):
     """ Bump roles SHA and copies their releases notes.
     Also bumps roles from external sources when the branch to bump is master.
     """
-    releasing.freeze_ansible_role_requirements_file(filename=kwargs["file"])
+    if not run_in_daemon("freeze_roles_for_milestone", filename=kwargs["file"]):
+        releasing.freeze_ansible_role_requirements_file(filename=kwargs["file"])
+
+
+@releases.command("bump_all")
+@click.pass_obj
+@click.option(
+    "--path",
+    type=click.Path(file_okay=False, dir_okay=True, writable=True, resolve_path=True),
+    help="path to the folder containing YAML files to update with new SHAs",
+    default="playbooks/defaults/repo_packages/",
+)
+@click.option(
+    "--file",
+    type=click.Path(file_okay=True, dir_okay=False, writable=True),
+    help="path to ansible-role-requirements.yml",
+    default="ansible-role-requirements.yml",
+)
+@click.option(
+    "--freeze",
+    is_flag=True,
+    help="freeze the roles for a milestone instead of unfreezing master",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="patch the SHA lines in place instead of reloading the whole YAML files",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="maximum number of repos resolved concurrently",
+    default=8,
+)
+@click.argument("os_branch")
+def bump_all(global_ctx, **kwargs):
+    """ Bump upstream projects and roles SHAs at once.
+    Each repo and branch referenced in both file types is resolved only once.
+    """
+    bump_kwargs = dict(
+        path=kwargs["path"],
+        filename=kwargs["file"],
+        branchname=kwargs["os_branch"],
+        milestone_freeze=kwargs["freeze"],
+        stream=kwargs["stream"],
+        workers=kwargs["workers"],
+    )
+    if not run_in_daemon("bump_all", **bump_kwargs):
+        releasing.bump_all(**bump_kwargs)
 
 
+@releases.command("next_releases")
+@click.pass_obj
+@click.option(
+    "--repo",
+    "repos",
+    multiple=True,
+    type=click.Path(file_okay=False, dir_okay=True, exists=True),
+    help="path to a local git repository, can be given multiple times",
+    default=["."],
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["table", "json"]),
+    help="output format",
+    default="table",
+)
+@click.argument("refs", nargs=-1)
+def next_releases(global_ctx, **kwargs):
+    """ Compute the next release numbers of many git refs at once.
+    Version files are read from the git objects, without checkout.
+    Defaults to all the local branches when no ref is given.
+    """
+    try:
+        results = releasing.find_release_numbers(
+            kwargs["repos"], references=kwargs["refs"]
+        )
+    except NotGitRepository as e:
+        raise click.ClickException(str(e))
+    releasing.print_release_numbers(results, output_format=kwargs["output_format"])
+    errors = [result for result in results if result["error"]]
+    if errors:
+        raise click.ClickException(
+            "No release number found for %s ref(s)" % len(errors)
+        )
+
+
+@releases.command("daemon")
+@click.pass_obj
+@click.option(
+    "--interval",
+    type=int,
+    help="seconds between two background refreshes of the known refs",
+    default=300,
+)
+def run_daemon(global_ctx, **kwargs):
+    """ Serve bump requests, keeping the ref to sha cache warm.
+    While it runs, bump_all, bump_upstream_shas, bump_roles and
+    freeze_roles_for_milestone are sent to the daemon.
+    The socket location can be changed with OSA_RELEASES_SOCKET.
+    """
+    daemon.serve(interval=kwargs["interval"])
+
+
+@releases.command("refresh_daemon")
+@click.pass_obj
+def refresh_daemon(global_ctx, **kwargs):
+    """ Ask the running daemon to refresh all its known refs now.
+    """
+    if not run_in_daemon("refresh"):
+        raise click.ClickException("No daemon listening on %s" % daemon.SOCKET_PATH)
@@ -0,0 +1,165 @@
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import threading
+import osa_cli_releases.releasing as releasing
+
+
+SOCKET_PATH = os.environ.get(
+    "OSA_RELEASES_SOCKET", os.path.join(releasing.get_cache_dir(), "daemon.sock")
+)
+
+COMMANDS = {
+    "bump_all": releasing.bump_all,
+    "bump_upstream_shas": releasing.bump_upstream_repos_shas,
+    "bump_roles": releasing.update_ansible_role_requirements_file,
+    "freeze_roles_for_milestone": releasing.freeze_ansible_role_requirements_file,
+}
+
+
+def refresh_refs():
+    """ Asks the remotes for the current sha of every cached reference
+    References which cannot be resolved anymore are dropped from the cache.
+    :returns: None
+    """
+    for repo_url, reference in list(releasing.SHA_CACHE):
+        try:
+            releasing.SHA_CACHE[(repo_url, reference)] = releasing.query_sha_from_ref(
+                repo_url, reference
+            )
+        except (subprocess.CalledProcessError, ValueError, IndexError):
+            releasing.SHA_CACHE.pop((repo_url, reference), None)
+
+
+COMMANDS["refresh"] = refresh_refs
+
+
+def run_request(request):
+    """ Runs a command on behalf of a client
+    :param request: dict containing the 'command' name, its 'kwargs', and
+                    the 'cwd' of the client
+    :returns: dict containing the command 'output' and the 'error', if any
+    """
+    if request.get("command") not in COMMANDS:
+        return {"output": "", "error": "Unknown command %s" % request.get("command")}
+    output = io.StringIO()
+    error = None
+    previous_cwd = os.getcwd()
+    try:
+        # Some commands work relative to the client folder (release notes)
+        os.chdir(request.get("cwd", previous_cwd))
+        with contextlib.redirect_stdout(output):
+            COMMANDS[request["command"]](**request.get("kwargs", {}))
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+    finally:
+        os.chdir(previous_cwd)
+    return {"output": output.getvalue(), "error": error}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ Handles one JSON encoded request per connection """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # is_running only connects, there is nothing to answer
+            return
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError as e:
+            response = {"output": "", "error": "Invalid request: %s" % e}
+        else:
+            if isinstance(request, dict):
+                response = run_request(request)
+            else:
+                response = {"output": "", "error": "Invalid request: not an object"}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """ Serves bump requests on a local socket, keeping the ref cache warm
+    Requests are handled one at a time, as they change files and cwd.
+    The refs are refreshed in the background until server_close is called.
+    :param socket_path: Location of the unix socket to listen on
+    :param interval: Seconds between two background refreshes of the refs
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH, interval=300):
+        if is_running(socket_path):
+            raise RuntimeError("A daemon is already listening on %s" % socket_path)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        super().__init__(socket_path, RequestHandler)
+        releasing.SHA_CACHE = {}
+        self.stop = threading.Event()
+        self.refresher = threading.Thread(
+            target=self.refresh_loop, args=(interval,), daemon=True
+        )
+        self.refresher.start()
+
+    def server_bind(self):
+        super().server_bind()
+        # Whoever can connect can rewrite files as the daemon user
+        os.chmod(self.server_address, 0o600)
+
+    def refresh_loop(self, interval):
+        while not self.stop.wait(interval):
+            refresh_refs()
+
+    def server_close(self):
+        super().server_close()
+        self.stop.set()
+        self.refresher.join()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        releasing.SHA_CACHE = None
+
+
+def serve(socket_path=SOCKET_PATH, interval=300):
+    """ Runs a DaemonServer until interrupted
+    :param socket_path: Location of the unix socket to listen on
+    :param interval: Seconds between two background refreshes of the refs
+    :returns: None
+    """
+    server = DaemonServer(socket_path, interval)
+    try:
+        print("Listening on %s" % socket_path)
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def is_running(socket_path=SOCKET_PATH):
+    """ Checks whether a daemon is listening on the socket
+    :param socket_path: Location of the unix socket
+    :returns: Boolean
+    """
+    try:
+        with contextlib.closing(socket.socket(socket.AF_UNIX)) as sock:
+            sock.connect(socket_path)
+    except OSError:
+        # No socket, nobody listening, or a socket we cannot use: the
+        # commands then run locally.
+        return False
+    return True
+
+
+def send_request(command, socket_path=SOCKET_PATH, **kwargs):
+    """ Asks the daemon to run a command
+    :param command: Name of the command, a key of COMMANDS
+    :param socket_path: Location of the unix socket
+    :param kwargs: Arguments of the command
+    :returns: dict containing the command 'output' and the 'error', if any
+    """
+    request = {"command": command, "kwargs": kwargs, "cwd": os.getcwd()}
+    with contextlib.closing(socket.socket(socket.AF_UNIX)) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as response:
+            return json.loads(response.readline().decode("utf-8"))
@@ -1,9 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import glob
+import json
 import os
 import shutil
 import subprocess
 import tempfile
+from dulwich.errors import NotTreeError  # dulwich
+from dulwich.objects import Tag  # dulwich
+from dulwich.object_store import tree_lookup_path  # dulwich
 from dulwich.repo import Repo  # dulwich
 import requests  # requests
 import requirements as pyrequirements  # requirements-parser
@@ -96,15 +101,20 @@ def print_requirements_state(pins, latest_versions, constraints_versions):
     print(table)
 
 
-def bump_upstream_repos_shas(path):
+def bump_upstream_repos_shas(path, stream=False):
     """ Processes all the yaml files in the path by updating their upstream repos shas
     :param path: String containing the location of the yaml files to update
+    :param stream: Patch the files line by line instead of round-tripping
+                   them through ruamel.yaml
     :returns: None
     """
     filelist = find_yaml_files(path)
     for filename in filelist:
         print("Working on %s" % filename)
-        bump_upstream_repos_sha_file(filename)
+        if stream:
+            bump_upstream_repos_sha_file_stream(filename)
+        else:
+            bump_upstream_repos_sha_file(filename)
 
 
 def find_yaml_files(path):
@@ -148,6 +158,129 @@ def bump_upstream_repos_sha_file(filename):
         yaml.explicit_start = False
 
 
+REPO_PACKAGES_KEY = re.compile(
+    r"^(?P<project>\w+?)_git_(?P<field>repo|install_branch|track_branch)$"
+)
+
+EOL_COMMENT = re.compile(r"^(?P<gap>[ \t]+)#[^\r\n]*")
+
+
+def scan_repos_file(filename):
+    """ Finds the repos values of a repo_packages file from its YAML events
+    No document tree is built: the file is parsed as a stream, and only the
+    top level *_git_repo, *_git_install_branch and *_git_track_branch values
+    are kept, with their location in the file.
+    :param filename: String containing path to file to analyse
+    :returns: Dict whose keys are projects and values are dicts, whose keys
+              are the fields (repo, install_branch, track_branch) and values
+              are (value, start mark, end mark) tuples.
+    """
+    fields = dict()
+    depth = 0
+    key = None
+    with open(filename, "r") as ossyml:
+        for event in yaml.parse(ossyml):
+            if isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                depth -= 1
+                continue
+            if depth == 1:
+                if key is None:
+                    # Keys of the top level mapping
+                    key = event.value if isinstance(event, yaml.ScalarEvent) else ""
+                else:
+                    match = REPO_PACKAGES_KEY.match(key)
+                    if match and isinstance(event, yaml.ScalarEvent):
+                        fields.setdefault(match.group("project"), {})[
+                            match.group("field")
+                        ] = (event.value, event.start_mark, event.end_mark)
+                    key = None
+            if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                depth += 1
+    return fields
+
+
+def index_repos_file(filename):
+    """ Builds the repos dict of a repo_packages file without loading it
+    :param filename: String containing path to file to analyse
+    :returns: Dict of repos, in the same format as build_repos_dict.
+    """
+    return build_repos_dict_from_fields(scan_repos_file(filename))
+
+
+def build_repos_dict_from_fields(fields):
+    """ Returns a structured dict of repos data from scanned fields
+    :param fields: Dict as returned by scan_repos_file
+    :returns: Dict of repos, in the same format as build_repos_dict.
+    """
+    return {
+        project: {
+            "url": data["repo"][0],
+            "sha": data["install_branch"][0] if "install_branch" in data else None,
+            "trackbranch": data["track_branch"][0] if "track_branch" in data else "None",
+        }
+        for project, data in fields.items()
+        if "repo" in data
+    }
+
+
+def bump_upstream_repos_sha_file_stream(filename):
+    """ Same as bump_upstream_repos_sha_file, patching the file line by line
+    Only the *_git_install_branch values and their end of line comments are
+    rewritten, every other byte of the file is kept as is. Memory is bounded
+    by the number of repos in the file, not by its size.
+    :param filename: String containing path to file to update
+    :returns: None
+    """
+    fields = scan_repos_file(filename)
+    # line where the value starts -> (start mark, end mark, new sha)
+    patches = dict()
+    for project, projectdata in build_repos_dict_from_fields(fields).items():
+        # a _git_track_branch string of "None" means no tracking, which means
+        # do not update (as there is no branch to track)
+        if projectdata["trackbranch"] != "None":
+            print(
+                "Bumping project %s on its %s branch"
+                % (projectdata["url"], projectdata["trackbranch"])
+            )
+            sha = get_sha_from_ref(projectdata["url"], projectdata["trackbranch"])
+            if "install_branch" in fields[project]:
+                _, start, end = fields[project]["install_branch"]
+                patches[start.line] = (start, end, sha)
+        else:
+            print(
+                "Skipping project %s branch %s"
+                % (projectdata["url"], projectdata["trackbranch"])
+            )
+
+    comment = "# HEAD as of {:%d.%m.%Y}".format(datetime.now())
+    # newline="" keeps the line endings (e.g. CRLF) untouched
+    with open(filename, "r", newline="") as ossyml, tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(os.path.abspath(filename)), delete=False,
+        newline="",
+    ) as fw:
+        patch = None
+        for lineno, line in enumerate(ossyml):
+            if patch is None and lineno in patches:
+                patch = patches[lineno]
+                prefix = line[: patch[0].column]
+            if patch is None:
+                fw.write(line)
+                continue
+            # Values may span lines (folded by ruamel): drop until their end
+            if lineno < patch[1].line:
+                continue
+            remainder = line[patch[1].column:]
+            eol = EOL_COMMENT.match(remainder)
+            if eol:
+                remainder = eol.group("gap") + comment + remainder[eol.end():]
+            else:
+                remainder = "  " + comment + remainder.lstrip(" \t")
+            fw.write(prefix + patch[2] + remainder)
+            patch = None
+    shutil.copymode(filename, fw.name)
+    os.replace(fw.name, filename)
+
+
 # def parse_repos_info(filename):
 #    """ Take a file consisting of ordered entries
 #    *_git_repo, followed by *_git_install_branch, with a comment the branch to track,
@@ -181,8 +314,27 @@ def build_repos_dict(repofiledict):
     return repos
 
 
+# (repo_url, reference) -> sha. None disables caching; the daemon sets it
+# to a dict it keeps refreshed in the background.
+SHA_CACHE = None
+
+
 def get_sha_from_ref(repo_url, reference):
     """ Returns the sha corresponding to the reference for a repo
+    Served from SHA_CACHE when the daemon keeps it warm.
+    :param repo_url: location of the git repository
+    :param reference: reference of the branch
+    :returns: utf-8 encoded string of the SHA found by the git command
+    """
+    if SHA_CACHE is None:
+        return query_sha_from_ref(repo_url, reference)
+    if (repo_url, reference) not in SHA_CACHE:
+        SHA_CACHE[(repo_url, reference)] = query_sha_from_ref(repo_url, reference)
+    return SHA_CACHE[(repo_url, reference)]
+
+
+def query_sha_from_ref(repo_url, reference):
+    """ Asks the remote for the sha corresponding to the reference for a repo
     :param repo_url: location of the git repository
     :param reference: reference of the branch
     :returns: utf-8 encoded string of the SHA found by the git command
@@ -197,7 +349,7 @@ def get_sha_from_ref(repo_url, reference):
     refs = [
         (line.split(b"\t")[1], line.split(b"\t")[0])
         for line in out.split(b"\n")
-        if line != b"" and b"^{}" not in line
+        if line != b"" and (b"^{}" not in line or reference.endswith("^{}"))
     ]
     if len(refs) > 1:
         raise ValueError(
@@ -207,6 +359,170 @@ def get_sha_from_ref(repo_url, reference):
     return refs[0][1].decode("utf-8")
 
 
+def get_role_sha(repo_url, trackbranch):
+    """ Returns the commit sha a clone of the role on trackbranch would get
+    Like git clone -b, branches are preferred over tags, and annotated tags
+    are peeled to their commit.
+    :param repo_url: location of the git repository
+    :param trackbranch: branch (or tag) tracked by the role
+    :returns: utf-8 encoded string of the commit SHA
+    """
+    references = [
+        "refs/heads/" + trackbranch,
+        "refs/tags/%s^{}" % trackbranch,
+        "refs/tags/" + trackbranch,
+    ]
+    for reference in references[:-1]:
+        try:
+            return get_sha_from_ref(repo_url, reference)
+        except subprocess.CalledProcessError:
+            # ls-remote --exit-code returns 2 when nothing matches
+            pass
+    return get_sha_from_ref(repo_url, references[-1])
+
+
+OSA_BRANCHES = [
+    "master",
+    "stable/ocata",
+    "stable/pike",
+    "stable/queens",
+    "stable/rocky",
+    "stable/stein",
+    "stable/train",
+    "stable/ussuri",
+    "stable/victoria",
+    "stable/wallaby",
+]
+
+
+def normalize_git_url(url):
+    """ Returns a canonical form of a git url, to detect identical repos
+    :param url: location of the git repository
+    :returns: String
+    """
+    url = url.rstrip("/")
+    if url.endswith(".git"):
+        url = url[: -len(".git")]
+    # git.openstack.org redirects to opendev.org
+    return url.replace("https://git.openstack.org/", "https://opendev.org/")
+
+
+def index_tracked_repos(path, filename, branchname, milestone_freeze=False,
+                        stream=False):
+    """ Lists the repos to resolve in repo_packages and ansible-role-requirements
+    :param path: String containing the location of the repo_packages files
+    :param filename: Path to the ansible-role-requirements file
+    :param branchname: Branch bumped in ansible-role-requirements
+    :param milestone_freeze: Whether ansible-role-requirements is frozen
+    :param stream: Index the repo_packages files as their stream bump does
+    :returns: Dict whose keys are (normalized url, trackbranch) and values are
+              the list of (url, reference) used to bump the files.
+    """
+    pairs = []
+    for repofilename in find_yaml_files(path):
+        if stream:
+            repos = index_repos_file(repofilename)
+        else:
+            with open(repofilename, "r") as ossyml:
+                repos = build_repos_dict(yaml.safe_load(ossyml))
+        for projectdata in repos.values():
+            if projectdata["trackbranch"] != "None":
+                pairs.append((projectdata["url"], projectdata["trackbranch"]))
+    # Unfreezing master only writes the trackbranch, there is nothing to resolve
+    if branchname != "master" or milestone_freeze:
+        _, _, all_roles = sort_roles(filename)
+        for role in all_roles:
+            # Cloned roles are included too: their clone is pinned to the
+            # resolved sha (see pin_role_clone).
+            if not is_role_tracked(role):
+                continue
+            # Same reference as the first one tried by get_role_sha
+            pairs.append((role["src"], "refs/heads/" + role["trackbranch"]))
+
+    index = dict()
+    for url, reference in pairs:
+        trackbranch = reference
+        if trackbranch.startswith("refs/heads/"):
+            trackbranch = trackbranch[len("refs/heads/"):]
+        references = index.setdefault((normalize_git_url(url), trackbranch), [])
+        if (url, reference) in references:
+            continue
+        # Explicit branch references are the least ambiguous to resolve
+        if reference.startswith("refs/heads/"):
+            references.insert(0, (url, reference))
+        else:
+            references.append((url, reference))
+    return index
+
+
+def resolve_shas(pairs, workers=8):
+    """ Resolves many (url, reference) pairs concurrently
+    :param pairs: Iterable of (url, reference) tuples
+    :param workers: Maximum number of concurrent git ls-remote
+    :returns: Dict whose keys are the pairs and values are the shas, or None
+              when the reference was not found.
+    """
+    def resolve(pair):
+        try:
+            return get_sha_from_ref(*pair)
+        except subprocess.CalledProcessError:
+            # Left to the bump itself, which reports it in its context
+            return None
+
+    pairs = list(pairs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shas = executor.map(resolve, pairs)
+        return dict(zip(pairs, shas))
+
+
+def bump_all(path, filename, branchname, milestone_freeze=False, stream=False,
+             workers=8):
+    """ Bumps repo_packages and ansible-role-requirements together
+    Each unique (url, trackbranch) is resolved once with git ls-remote,
+    concurrently, whichever files and spellings of the url reference it.
+    Roles whose release notes are copied are then cloned one after the
+    other, each clone being pinned to the resolved sha.
+    :param path: String containing the location of the repo_packages files
+    :param filename: Path to the ansible-role-requirements file
+    :param branchname: Branch bumped in ansible-role-requirements
+    :param milestone_freeze: Whether ansible-role-requirements is frozen
+    :param stream: Patch the repo_packages files line by line
+    :param workers: Maximum number of concurrent git ls-remote
+    :returns: None
+    """
+    global SHA_CACHE
+    if branchname not in OSA_BRANCHES:
+        raise ValueError("Branch not recognized %s" % branchname)
+
+    index = index_tracked_repos(
+        path, filename, branchname, milestone_freeze, stream=stream
+    )
+    print(
+        "Resolving %s unique repos for %s references"
+        % (len(index), sum(len(references) for references in index.values()))
+    )
+    resolved = resolve_shas(
+        [references[0] for references in index.values()], workers=workers
+    )
+
+    # Serve every spelling of a repo from the resolved shas, through the
+    # same cache the daemon uses (and keep it warm if the daemon runs).
+    previous_cache = SHA_CACHE
+    SHA_CACHE = previous_cache if previous_cache is not None else dict()
+    for references in index.values():
+        if resolved[references[0]] is None:
+            continue
+        for reference in references:
+            SHA_CACHE[reference] = resolved[references[0]]
+    try:
+        bump_upstream_repos_shas(path, stream=stream)
+        update_ansible_role_requirements_file(
+            filename, branchname=branchname, milestone_freeze=milestone_freeze
+        )
+    finally:
+        SHA_CACHE = previous_cache
+
+
 def freeze_ansible_role_requirements_file(filename=""):
     """ Freezes a-r-r for master"""
     update_ansible_role_requirements_file(
@@ -223,62 +539,58 @@ def update_ansible_role_requirements_file(
     Else, stable branches only get openstack roles bumped.
     Copies all the release notes of the roles at the same time.
     """
-    if branchname not in [
-        "master",
-        "stable/ocata",
-        "stable/pike",
-        "stable/queens",
-        "stable/rocky",
-        "stable/stein",
-        "stable/train",
-        "stable/ussuri",
-        "stable/victoria",
-        "stable/wallaby",
-    ]:
+    if branchname not in OSA_BRANCHES:
         raise ValueError("Branch not recognized %s" % branchname)
 
     openstack_roles, external_roles, all_roles = sort_roles(filename)
 
     clone_root_path = tempfile.mkdtemp()
+    commit_times = load_commit_times_cache()
 
     for role in all_roles:
-        trackbranch = role.get("trackbranch")
-        if not trackbranch or trackbranch.lower() == "none":
+        if not is_role_tracked(role):
             print(
                 "Skipping role %s branch" % role["name"]
             )
             continue
 
-        copyreleasenotes = False
+        trackbranch = role["trackbranch"]
 
         shallow_since = role.get("shallow_since")
 
-        # We don't want to copy config_template renos even if it's an openstack
-        # role, as it's not branched the same way.
-        if role in openstack_roles and (not role["src"].endswith("config_template")):
-            copyreleasenotes = True
+        copyreleasenotes = role_needs_clone(role, openstack_roles)
 
         # Freeze sha by checking its trackbranch value
         # Do not freeze sha if trackbranch is None
         if trackbranch:
+            role_repo = None
             try:
-                role_repo = clone_role(
-                   role["src"], trackbranch, clone_root_path, depth="1"
-                )
+                # A clone is only needed for the release notes: the sha and
+                # its commit time are found without downloading the role.
+                if copyreleasenotes:
+                    role_repo = clone_role(
+                       role["src"], trackbranch, clone_root_path, depth="1"
+                    )
                 # Unfreeze on master, not bump
                 if branchname == "master" and not milestone_freeze:
                     print("Unfreeze master role")
                     role["version"] = trackbranch
                 # Freeze or Bump
                 else:
-                    role_head = role_repo.head()
-                    role["version"] = role_head.decode()
+                    if role_repo and SHA_CACHE is None:
+                        role["version"] = role_repo.head().decode()
+                    else:
+                        # With a sha cache (bump_all, daemon), the sha was
+                        # resolved for every file: the clone must follow it.
+                        role["version"] = get_role_sha(role["src"], trackbranch)
+                        if role_repo:
+                            pin_role_clone(role_repo, role["version"])
                     print("Bumped role %s to sha %s" % (role["name"], role["version"]))
 
                     if shallow_since:
-                        head_timestamp = role_repo[role_head].commit_time
-                        head_datetime = datetime.fromtimestamp(head_timestamp) - timedelta(days=1)
-                        role["shallow_since"] = head_datetime.strftime('%Y-%m-%d')
+                        role["shallow_since"] = get_shallow_since(
+                            role["src"], role["version"], commit_times, repo=role_repo
+                        )
 
                 # Copy the release notes `Also handle the release notes
                 # If frozen, no need to copy release notes.
@@ -286,15 +598,37 @@ def update_ansible_role_requirements_file(
                     print("Copying %s's release notes" % role["name"])
                     copy_role_releasenotes(role_repo.path, "./")
             finally:
-                shutil.rmtree(role_repo.path)
+                if role_repo:
+                    shutil.rmtree(role_repo.path)
 
     shutil.rmtree(clone_root_path)
+    save_commit_times_cache(commit_times)
     print("Overwriting ansible-role-requirements")
     with open(filename, "w") as arryml:
         yaml = YAML()  # use ruamel.yaml to keep comments that could appear
         yaml.dump(all_roles, arryml)
 
 
+def is_role_tracked(role):
+    """ Whether a role follows a branch, and therefore can be bumped
+    :param role: dict of the role in ansible-role-requirements
+    :returns: Boolean
+    """
+    trackbranch = role.get("trackbranch")
+    return bool(trackbranch) and trackbranch.lower() != "none"
+
+
+def role_needs_clone(role, openstack_roles):
+    """ Whether a role is cloned to copy its release notes
+    :param role: dict of the role in ansible-role-requirements
+    :param openstack_roles: list of openstack roles, as given by sort_roles
+    :returns: Boolean
+    """
+    # We don't want to copy config_template renos even if it's an openstack
+    # role, as it's not branched the same way.
+    return role in openstack_roles and not role["src"].endswith("config_template")
+
+
 def sort_roles(ansible_role_requirements_file):
     """ Separate the openstack roles from the external roles
     :param ansible_role_requirements_file: Path to the a-r-r file
@@ -342,6 +676,116 @@ def clone_role(url, branch, clone_root_path, clone_folder=None, depth=None):
     return repo
 
 
+def get_cache_dir():
+    """ Returns the folder of the persistent caches, honouring XDG_CACHE_HOME
+    :returns: String
+    """
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "osa_cli_releases",
+    )
+
+
+def load_commit_times_cache(cache_path=None):
+    """ Loads the persistent sha -> commit_time cache
+    Commits are immutable, so the cache never needs invalidation.
+    :param cache_path: Location of the JSON cache file, defaults to
+                       commit_times.json in the cache folder
+    :returns: dict whose keys are shas and values are commit timestamps
+    """
+    if not cache_path:
+        cache_path = os.path.join(get_cache_dir(), "commit_times.json")
+    try:
+        with open(cache_path, "r") as cachefd:
+            return json.load(cachefd)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_commit_times_cache(cache, cache_path=None):
+    """ Writes the persistent sha -> commit_time cache
+    :param cache: dict whose keys are shas and values are commit timestamps
+    :param cache_path: Location of the JSON cache file, defaults to
+                       commit_times.json in the cache folder
+    :returns: None
+    """
+    if not cache_path:
+        cache_path = os.path.join(get_cache_dir(), "commit_times.json")
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write aside then rename, an interrupted run must not truncate the cache
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(cache_path), delete=False
+    ) as cachefd:
+        json.dump(cache, cachefd, indent=1, sort_keys=True)
+    os.replace(cachefd.name, cache_path)
+
+
+def fetch_commit_time(url, sha):
+    """ Fetches only the commit object of a sha, without trees nor blobs
+    :param url: Source of the git repo
+    :param sha: The sha of the commit
+    :returns: Commit timestamp (int)
+    """
+    fetch_path = tempfile.mkdtemp()
+    try:
+        subprocess.check_call(["git", "init", "--quiet", "--bare", fetch_path])
+        # tree:0 filter and depth 1 restrict the pack to the commit itself
+        subprocess.check_call(
+            [
+                "git", "-C", fetch_path, "fetch", "--quiet", "--no-tags",
+                "--depth", "1", "--filter=tree:0", url, sha,
+            ]
+        )
+        return Repo(fetch_path)[sha.encode("utf-8")].commit_time
+    finally:
+        shutil.rmtree(fetch_path)
+
+
+def get_commit_time(url, sha, cache, repo=None):
+    """ Returns the commit time of a sha, fetching it only if unknown
+    :param url: Source of the git repo
+    :param sha: The sha of the commit
+    :param cache: dict as returned by load_commit_times_cache, updated
+                  with the fetched commit times
+    :param repo: Optional dulwich repository object already containing the sha
+    :returns: Commit timestamp (int)
+    """
+    if sha not in cache:
+        if repo is not None:
+            cache[sha] = repo[sha.encode("utf-8")].commit_time
+        else:
+            cache[sha] = fetch_commit_time(url, sha)
+    return cache[sha]
+
+
+def get_shallow_since(url, sha, cache, repo=None):
+    """ Returns the shallow_since date of a role: the day before its commit
+    :param url: Source of the git repo
+    :param sha: The sha the role is frozen to
+    :param cache: dict as returned by load_commit_times_cache
+    :param repo: Optional dulwich repository object already containing the sha
+    :returns: String formatted as YYYY-MM-DD
+    """
+    commit_time = get_commit_time(url, sha, cache, repo=repo)
+    commit_datetime = datetime.fromtimestamp(commit_time) - timedelta(days=1)
+    return commit_datetime.strftime("%Y-%m-%d")
+
+
+def pin_role_clone(repo, sha):
+    """ Checks out a sha in a shallow role clone, fetching it if needed
+    The branch may have moved between the sha resolution and the clone.
+    :param repo: dulwich repository object of the clone
+    :param sha: The sha the role is bumped to
+    :returns: None
+    """
+    if repo.head().decode() == sha:
+        return
+    subprocess.check_call(
+        ["git", "-C", repo.path, "fetch", "--quiet", "--depth", "1", "origin", sha]
+    )
+    subprocess.check_call(["git", "-C", repo.path, "checkout", "--quiet", sha])
+
+
 def copy_role_releasenotes(src_path, dest_path):
     """ Copy release notes from src to dest
     """
@@ -352,16 +796,20 @@ def copy_role_releasenotes(src_path, dest_path):
         )
 
 
+OA_VERSION_FILES = [
+    "inventory/group_vars/all/all.yml",
+    "group_vars/all/all.yml",
+    "playbooks/inventory/group_vars/all.yml",
+]
+
+RELEASE_TYPES = ("bugfix", "feature", "milestone", "rc")
+
+
 def find_release_number():
     """ Find a release version amongst usual OSA files
     :returns: version (str),  filename containing version (string)
     """
-    oa_version_files = [
-        "inventory/group_vars/all/all.yml",
-        "group_vars/all/all.yml",
-        "playbooks/inventory/group_vars/all.yml",
-    ]
-    for filename in oa_version_files:
+    for filename in OA_VERSION_FILES:
         try:
             with open(filename, "r") as vf:
                 version = yaml.safe_load(vf)["openstack_release"]
@@ -374,6 +822,160 @@ def find_release_number():
     return version, found_file
 
 
+def resolve_ref(repo, reference):
+    """ Returns the commit a reference points to, without any checkout
+    :param repo: dulwich repository object
+    :param reference: full ref name, short branch/tag name, or sha
+    :returns: dulwich Commit object
+    """
+    ref = reference.encode("utf-8")
+    candidates = [
+        ref,
+        b"refs/heads/" + ref,
+        b"refs/tags/" + ref,
+        b"refs/remotes/origin/" + ref,
+    ]
+    for candidate in candidates:
+        if candidate in repo.refs:
+            obj = repo[repo.refs[candidate]]
+            break
+    else:
+        try:
+            obj = repo[ref]
+        except (KeyError, ValueError):
+            raise KeyError("Reference %s not found in %s" % (reference, repo.path))
+    # Annotated tags point to a tag object, peel it down to the commit.
+    while isinstance(obj, Tag):
+        obj = repo[obj.object[1]]
+    return obj
+
+
+def read_file_from_ref(repo, reference, path):
+    """ Reads a file straight from the git object store
+    :param repo: dulwich repository object
+    :param reference: reference at which the file should be read
+    :param path: path of the file, relative to the repository root
+    :returns: bytes content of the file
+    """
+    commit = resolve_ref(repo, reference)
+    try:
+        _, sha = tree_lookup_path(
+            repo.object_store.__getitem__, commit.tree, path.encode("utf-8")
+        )
+    except NotTreeError:
+        # A component of the path is a file: the path does not exist
+        raise KeyError(path)
+    return repo[sha].data
+
+
+def find_release_number_from_ref(repo, reference):
+    """ Find a release version amongst usual OSA files, at a given reference
+    :param repo: dulwich repository object
+    :param reference: reference at which the version files should be read
+    :returns: version (str),  filename containing version (string)
+    """
+    # Resolve first, so that an unknown reference is not reported as
+    # a missing version file.
+    commit = resolve_ref(repo, reference)
+    for filename in OA_VERSION_FILES:
+        try:
+            content = read_file_from_ref(repo, commit.id.decode("utf-8"), filename)
+        except KeyError:
+            continue
+        versions = yaml.safe_load(content)
+        if not isinstance(versions, dict) or "openstack_release" not in versions:
+            raise KeyError(
+                "No openstack_release in %s at %s" % (filename, reference)
+            )
+        return str(versions["openstack_release"]), filename
+    raise FileNotFoundError(
+        "No file found matching the list of files in %s" % reference
+    )
+
+
+def find_release_numbers(repo_paths, references=None, releasetypes=RELEASE_TYPES):
+    """ Computes the next release numbers of many references in one pass
+    Version files are read from the git object store, so the repos
+    do not need to be checked out at each reference.
+    :param repo_paths: List of paths of local git repositories
+    :param references: List of references to inspect in every repository.
+                       Defaults to all the local branches of each repository,
+                       and its origin remote branches (e.g. the stable
+                       branches of a fresh clone).
+    :param releasetypes: Release types for which a next version is computed
+    :returns: List of dicts, one per (repository, reference), containing
+              the current version, the version file, the next version
+              for each release type (None when not applicable), and the
+              error preventing to find the version (None if found).
+    """
+    results = []
+    for repo_path in repo_paths:
+        repo = Repo(repo_path)
+        if references:
+            repo_refs = references
+        else:
+            # resolve_ref prefers the local branch when both exist
+            repo_refs = sorted(
+                set(repo.refs.keys(base=b"refs/heads/"))
+                | set(repo.refs.keys(base=b"refs/remotes/origin/")) - {b"HEAD"}
+            )
+            repo_refs = [ref.decode("utf-8") for ref in repo_refs]
+        for reference in repo_refs:
+            result = {
+                "repo": repo_path,
+                "ref": reference,
+                "file": None,
+                "current": None,
+                "error": None,
+            }
+            results.append(result)
+            try:
+                version, filename = find_release_number_from_ref(repo, reference)
+            except (KeyError, FileNotFoundError, yaml.YAMLError) as e:
+                # Keep going, one broken branch should not hide the others
+                if isinstance(e, KeyError) and e.args:
+                    result["error"] = e.args[0]
+                else:
+                    result["error"] = str(e)
+                for releasetype in releasetypes:
+                    result[releasetype] = None
+                continue
+            result["file"] = filename
+            result["current"] = version
+            for releasetype in releasetypes:
+                try:
+                    result[releasetype] = ".".join(
+                        next_release_number(version, releasetype)
+                    )
+                except (ValueError, IndexError):
+                    # e.g. an rc cannot follow a bugfix release
+                    result[releasetype] = None
+    return results
+
+
+def print_release_numbers(results, output_format="table",
+                          releasetypes=RELEASE_TYPES):
+    """ Shows the next release numbers computed by find_release_numbers
+    :param results: List of dicts as returned by find_release_numbers
+    :param output_format: Either "table" or "json"
+    :param releasetypes: Release types to display
+    :returns: Nothing
+    """
+    if output_format == "json":
+        print(json.dumps(results, indent=2))
+        return
+    table = PrettyTable(
+        ["Repo", "Ref", "Current version"] + list(releasetypes) + ["Error"]
+    )
+    for result in results:
+        table.add_row(
+            [result["repo"], result["ref"], result["current"] or "-"]
+            + [result[releasetype] or "-" for releasetype in releasetypes]
+            + [result["error"] or ""]
+        )
+    print(table)
+
+
 def next_release_number(current_version, releasetype):
     version = current_version.split(".")
     if releasetype in ("milestone", "rc"):
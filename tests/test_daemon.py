@@ -0,0 +1,74 @@
+import contextlib
+import json
+import os
+import socket
+import stat
+import threading
+import osa_cli_releases.daemon as daemon
+import osa_cli_releases.releasing as releasing
+
+
+def test_get_sha_from_ref_uses_cache(monkeypatch):
+    monkeypatch.setattr(
+        releasing, "SHA_CACHE", {("https://example.invalid/repo", "master"): "abc"}
+    )
+    assert releasing.get_sha_from_ref("https://example.invalid/repo", "master") == "abc"
+
+
+def test_refresh_refs(monkeypatch):
+    monkeypatch.setattr(
+        releasing, "SHA_CACHE", {("https://example.invalid/repo", "master"): "abc"}
+    )
+    monkeypatch.setattr(releasing, "query_sha_from_ref", lambda url, ref: "def")
+    daemon.refresh_refs()
+    assert releasing.SHA_CACHE == {("https://example.invalid/repo", "master"): "def"}
+
+
+def test_run_request_unknown_command():
+    response = daemon.run_request({"command": "unknown"})
+    assert response == {"output": "", "error": "Unknown command unknown"}
+
+
+def test_is_running_unusable_socket(tmp_path):
+    assert not daemon.is_running(str(tmp_path / "missing.sock"))
+    assert not daemon.is_running(str(tmp_path / ("x" * 200)))
+
+
+def test_serve_and_send_request(tmp_path, monkeypatch, capsys):
+    socket_path = str(tmp_path / "daemon.sock")
+    # The server installs its own cache, restore the global on teardown
+    monkeypatch.setattr(releasing, "SHA_CACHE", None)
+    monkeypatch.setitem(daemon.COMMANDS, "hello", lambda name: print("hi " + name))
+    server = daemon.DaemonServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert daemon.is_running(socket_path)
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        response = daemon.send_request("hello", socket_path=socket_path, name="osa")
+        assert response == {"output": "hi osa\n", "error": None}
+        response = daemon.send_request("hello", socket_path=socket_path)
+        assert response["error"].startswith("TypeError")
+
+        # Clients probe the daemon before each request
+        assert daemon.is_running(socket_path)
+        response = daemon.send_request("hello", socket_path=socket_path, name="osa")
+        assert response == {"output": "hi osa\n", "error": None}
+
+        with contextlib.closing(socket.socket(socket.AF_UNIX)) as sock:
+            sock.connect(socket_path)
+            sock.sendall(b"not json\n")
+            with sock.makefile("rb") as fd:
+                response = json.loads(fd.readline().decode("utf-8"))
+        assert response["output"] == ""
+        assert response["error"].startswith("Invalid request")
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert not server.refresher.is_alive()
+    assert not os.path.exists(socket_path)
+    assert releasing.SHA_CACHE is None
+    # No traceback from the server thread
+    assert capsys.readouterr().err == ""
@@ -1,6 +1,12 @@
+from datetime import datetime, timedelta
+import os
+import subprocess
 import osa_cli_releases.releasing as releasing
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.repo import Repo
 from prettytable import PrettyTable
 from ruamel.yaml import YAML
+import yaml
 
 
 def test_parse_requirements():
@@ -85,6 +91,71 @@ def test_find_yaml_files():
 #    pass
 
 
+def test_index_repos_file():
+    path = "tests/fixtures/repo_packages/openstack_services.yml"
+    yaml = YAML()
+    with open(path, "r") as fd:
+        repofiledata = yaml.load(fd)
+    assert releasing.index_repos_file(path) == releasing.build_repos_dict(repofiledata)
+
+
+def test_bump_upstream_repos_sha_file_stream(tmp_path, monkeypatch):
+    monkeypatch.setattr(releasing, "get_sha_from_ref", lambda url, ref: "a" * 40)
+    with open("tests/fixtures/repo_packages/gnocchi.yml", "r") as fd:
+        original = fd.read()
+    filename = tmp_path / "gnocchi.yml"
+    filename.write_text(original)
+    releasing.bump_upstream_repos_sha_file_stream(str(filename))
+    changed = [
+        (before, after)
+        for before, after in zip(
+            original.splitlines(), filename.read_text().splitlines()
+        )
+        if before != after
+    ]
+    assert len(changed) == 1
+    assert changed[0][1].startswith(
+        "gnocchi_git_install_branch: " + "a" * 40 + " # HEAD as of "
+    )
+    assert len(original.splitlines()) == len(filename.read_text().splitlines())
+
+
+def test_bump_upstream_repos_sha_file_stream_crlf(tmp_path, monkeypatch):
+    monkeypatch.setattr(releasing, "get_sha_from_ref", lambda url, ref: "a" * 40)
+    with open("tests/fixtures/repo_packages/gnocchi.yml", "r") as fd:
+        original = fd.read().replace("\n", "\r\n")
+    filename = tmp_path / "gnocchi.yml"
+    with open(str(filename), "w", newline="") as fd:
+        fd.write(original)
+    releasing.bump_upstream_repos_sha_file_stream(str(filename))
+    with open(str(filename), "r", newline="") as fd:
+        bumped = fd.read()
+    assert bumped.count("\r\n") == original.count("\r\n")
+    assert bumped.count("\n") == original.count("\n")
+    assert "gnocchi_git_install_branch: " + "a" * 40 + " # HEAD as of " in bumped
+
+
+def test_bump_upstream_repos_sha_file_stream_after_ruamel(tmp_path, monkeypatch):
+    filename = tmp_path / "openstack_services.yml"
+    with open("tests/fixtures/repo_packages/openstack_services.yml", "r") as fd:
+        filename.write_text(fd.read())
+    monkeypatch.setattr(releasing, "get_sha_from_ref", lambda url, ref: "a" * 40)
+    releasing.bump_upstream_repos_sha_file(str(filename))
+    bumped = filename.read_text()
+    # ruamel folds the long values on a continuation line
+    assert "neutron_lbaas_dashboard_git_repo: \n  https://" in bumped
+
+    monkeypatch.setattr(releasing, "get_sha_from_ref", lambda url, ref: "b" * 40)
+    releasing.bump_upstream_repos_sha_file_stream(str(filename))
+    streamed = filename.read_text()
+    assert streamed == bumped.replace("a" * 40, "b" * 40)
+    repos = releasing.build_repos_dict(yaml.safe_load(streamed))
+    assert repos["neutron_lbaas_dashboard"]["url"] == (
+        "https://git.openstack.org/openstack/neutron-lbaas-dashboard"
+    )
+    assert repos["neutron_lbaas_dashboard"]["sha"] == "b" * 40
+
+
 # def test_parse_repos_infos():
 #    path = 'tests/fixtures/openstack_services.yml'
 #    oss = releasing.parse_repos_info(path)
@@ -110,6 +181,264 @@ def test_get_sha_from_ref():
     assert sha == "bf565c6ae34bb4343b4d6b486bd9b514de370b0a"
 
 
+def test_get_shallow_since_from_cache():
+    sha = "ac92973e1393cedf336ed4e295005c08c1a083e0"
+    # The url is never contacted when the sha is in cache
+    shallow_since = releasing.get_shallow_since(
+        "https://example.invalid/role", sha, {sha: 1546344000}
+    )
+    expected = datetime.fromtimestamp(1546344000) - timedelta(days=1)
+    assert shallow_since == expected.strftime("%Y-%m-%d")
+
+
+def test_get_commit_time_from_repo(tmp_path):
+    repo = Repo.init(str(tmp_path))
+    _commit_version_file(repo, "master", "group_vars/all/all.yml", "18.1.2")
+    sha = repo.refs[b"refs/heads/master"].decode("utf-8")
+    cache = {}
+    assert releasing.get_commit_time(
+        "https://example.invalid/role", sha, cache, repo=repo
+    ) == 0
+    assert cache == {sha: 0}
+
+
+def test_commit_times_cache(tmp_path):
+    cache_path = str(tmp_path / "cache" / "commit_times.json")
+    assert releasing.load_commit_times_cache(cache_path) == {}
+    releasing.save_commit_times_cache({"abc": 0}, cache_path)
+    assert releasing.load_commit_times_cache(cache_path) == {"abc": 0}
+    assert os.listdir(str(tmp_path / "cache")) == ["commit_times.json"]
+
+
+def test_commit_times_cache_follows_xdg(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    releasing.save_commit_times_cache({"abc": 0})
+    assert os.path.exists(str(tmp_path / "osa_cli_releases" / "commit_times.json"))
+    assert releasing.load_commit_times_cache() == {"abc": 0}
+
+
+def test_fetch_commit_time(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    subprocess.check_call(["git", "-C", str(source), "init", "--quiet"])
+    subprocess.check_call(
+        ["git", "-C", str(source), "-c", "user.name=Test",
+         "-c", "user.email=test@example.com", "commit", "--quiet",
+         "--allow-empty", "-m", "first"],
+        env=dict(os.environ, GIT_COMMITTER_DATE="1546344000 +0000"),
+    )
+    sha = subprocess.check_output(
+        ["git", "-C", str(source), "rev-parse", "HEAD"]
+    ).decode("utf-8").strip()
+    assert releasing.fetch_commit_time("file://" + str(source), sha) == 1546344000
+
+
+def test_get_role_sha(tmp_path):
+    def git(*args):
+        return subprocess.check_output(
+            ["git", "-C", str(tmp_path), "-c", "user.name=Test",
+             "-c", "user.email=test@example.com"] + list(args)
+        ).decode("utf-8").strip()
+
+    git("init", "--quiet", "-b", "master")
+    git("commit", "--quiet", "--allow-empty", "-m", "first")
+    first = git("rev-parse", "HEAD")
+    git("tag", "-a", "18.0.0", "-m", "18.0.0")
+    git("commit", "--quiet", "--allow-empty", "-m", "second")
+    git("branch", "foo/master")
+    url = "file://" + str(tmp_path)
+    # Not confused by foo/master, as ls-remote master would be
+    assert releasing.get_role_sha(url, "master") == git("rev-parse", "HEAD")
+    # Annotated tags are peeled to their commit
+    assert releasing.get_role_sha(url, "18.0.0") == first
+
+
+def test_update_ansible_role_requirements_file_without_clone(tmp_path, monkeypatch):
+    arr = tmp_path / "ansible-role-requirements.yml"
+    arr.write_text(
+        "- name: ceph-ansible\n"
+        "  scm: git\n"
+        "  src: https://github.com/ceph/ceph-ansible\n"
+        "  version: v3.1.0\n"
+        "  trackbranch: stable-3.1\n"
+        "  shallow_since: '2018-01-01'\n"
+    )
+    saved = []
+    monkeypatch.setattr(releasing, "load_commit_times_cache", lambda: {})
+    monkeypatch.setattr(releasing, "save_commit_times_cache", saved.append)
+    monkeypatch.setattr(
+        releasing, "query_sha_from_ref", lambda url, ref: "a" * 40
+    )
+    monkeypatch.setattr(releasing, "fetch_commit_time", lambda url, sha: 1546344000)
+
+    def clone_role(*args, **kwargs):
+        raise AssertionError("External roles should not be cloned")
+
+    monkeypatch.setattr(releasing, "clone_role", clone_role)
+    releasing.update_ansible_role_requirements_file(str(arr), "stable/rocky")
+    _, _, all_roles = releasing.sort_roles(str(arr))
+    expected = datetime.fromtimestamp(1546344000) - timedelta(days=1)
+    assert all_roles[0]["version"] == "a" * 40
+    assert all_roles[0]["shallow_since"] == expected.strftime("%Y-%m-%d")
+    assert saved == [{"a" * 40: 1546344000}]
+
+
+def _write_shared_repos(tmp_path):
+    """ Creates a repo_packages folder and a-r-r sharing the gnocchi repo """
+    repo_packages = tmp_path / "repo_packages"
+    repo_packages.mkdir()
+    with open("tests/fixtures/repo_packages/gnocchi.yml", "r") as fd:
+        (repo_packages / "gnocchi.yml").write_text(fd.read())
+    arr = tmp_path / "ansible-role-requirements.yml"
+    arr.write_text(
+        "- name: gnocchi\n"
+        "  scm: git\n"
+        "  src: https://github.com/gnocchixyz/gnocchi.git\n"
+        "  version: 711e51f706dcc5bc97ad14ddc8108e501befee23\n"
+        "  trackbranch: stable/4.3\n"
+    )
+    return str(repo_packages), str(arr)
+
+
+def test_index_tracked_repos(tmp_path):
+    path, filename = _write_shared_repos(tmp_path)
+    assert releasing.index_tracked_repos(path, filename, "stable/rocky") == {
+        ("https://github.com/gnocchixyz/gnocchi", "stable/4.3"): [
+            ("https://github.com/gnocchixyz/gnocchi.git", "refs/heads/stable/4.3"),
+            ("https://github.com/gnocchixyz/gnocchi", "stable/4.3"),
+        ]
+    }
+    # Unfreezing master does not need the roles shas
+    assert len(releasing.index_tracked_repos(path, filename, "master")[
+        ("https://github.com/gnocchixyz/gnocchi", "stable/4.3")
+    ]) == 1
+
+
+def test_index_tracked_repos_folded_values(tmp_path, monkeypatch):
+    path, filename = _write_shared_repos(tmp_path)
+    repofile = tmp_path / "repo_packages" / "openstack_services.yml"
+    with open("tests/fixtures/repo_packages/openstack_services.yml", "r") as fd:
+        repofile.write_text(fd.read())
+    monkeypatch.setattr(releasing, "get_sha_from_ref", lambda url, ref: "a" * 40)
+    # Written by ruamel, which folds the long values
+    releasing.bump_upstream_repos_sha_file(str(repofile))
+    index = releasing.index_tracked_repos(path, filename, "stable/rocky")
+    assert all(url is not None for url, _ in index)
+    assert (
+        "https://opendev.org/openstack/neutron-lbaas-dashboard", "master"
+    ) in index
+    assert index == releasing.index_tracked_repos(
+        path, filename, "stable/rocky", stream=True
+    )
+
+
+def test_role_needs_clone():
+    openstack_role = {
+        "src": "https://opendev.org/openstack/openstack-ansible-os_nova",
+        "trackbranch": "master",
+    }
+    config_template = {
+        "src": "https://opendev.org/openstack/ansible-config_template",
+        "trackbranch": "None",
+    }
+    openstack_roles = [openstack_role, config_template]
+    assert releasing.is_role_tracked(openstack_role)
+    assert not releasing.is_role_tracked(config_template)
+    assert not releasing.is_role_tracked({"src": "https://example.invalid"})
+    assert releasing.role_needs_clone(openstack_role, openstack_roles)
+    assert not releasing.role_needs_clone(config_template, openstack_roles)
+
+
+def test_bump_all(tmp_path, monkeypatch):
+    path, filename = _write_shared_repos(tmp_path)
+    queries = []
+
+    def query_sha_from_ref(url, reference):
+        queries.append((url, reference))
+        return "a" * 40
+
+    monkeypatch.setattr(releasing, "query_sha_from_ref", query_sha_from_ref)
+    monkeypatch.setattr(releasing, "load_commit_times_cache", lambda: {})
+    monkeypatch.setattr(releasing, "save_commit_times_cache", lambda cache: None)
+    releasing.bump_all(path, filename, "stable/rocky", stream=True)
+    assert len(queries) == 1
+    assert releasing.SHA_CACHE is None
+    assert releasing.index_repos_file(path + "/gnocchi.yml")["gnocchi"]["sha"] == "a" * 40
+    _, _, all_roles = releasing.sort_roles(filename)
+    assert all_roles[0]["version"] == "a" * 40
+
+
+def test_bump_all_pins_cloned_roles(tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    source.mkdir()
+
+    def git(*args):
+        return subprocess.check_output(
+            ["git", "-C", str(source), "-c", "user.name=Test",
+             "-c", "user.email=test@example.com"] + list(args)
+        ).decode("utf-8").strip()
+
+    git("init", "--quiet", "-b", "master")
+    notes = source / "releasenotes" / "notes"
+    notes.mkdir(parents=True)
+    (notes / "first.yaml").write_text("---\n")
+    git("add", "-A")
+    git("commit", "--quiet", "-m", "first")
+    resolved = git("rev-parse", "HEAD")
+    # Lands between the sha resolution and the role clone
+    (notes / "second.yaml").write_text("---\n")
+    git("add", "-A")
+    git("commit", "--quiet", "-m", "second")
+
+    url = "https://opendev.org/openstack/openstack-ansible-os_nova"
+    repo_packages = tmp_path / "repo_packages"
+    repo_packages.mkdir()
+    (repo_packages / "nova.yml").write_text(
+        "nova_git_repo: {}\n"
+        "nova_git_install_branch: 0000000000000000000000000000000000000000\n"
+        "nova_git_track_branch: master\n".format(url)
+    )
+    arr = tmp_path / "ansible-role-requirements.yml"
+    arr.write_text(
+        "- name: os_nova\n"
+        "  scm: git\n"
+        "  src: {}\n"
+        "  version: master\n"
+        "  trackbranch: master\n".format(url)
+    )
+
+    queries = []
+
+    def query_sha_from_ref(url, reference):
+        queries.append((url, reference))
+        return resolved
+
+    clone_role = releasing.clone_role
+    copied = []
+    monkeypatch.setattr(releasing, "query_sha_from_ref", query_sha_from_ref)
+    monkeypatch.setattr(
+        releasing, "clone_role",
+        lambda url, *args, **kwargs: clone_role("file://" + str(source), *args, **kwargs),
+    )
+    monkeypatch.setattr(
+        releasing, "copy_role_releasenotes",
+        lambda src, dest: copied.extend(
+            sorted(os.listdir(os.path.join(src, "releasenotes", "notes")))
+        ),
+    )
+    monkeypatch.setattr(releasing, "load_commit_times_cache", lambda: {})
+    monkeypatch.setattr(releasing, "save_commit_times_cache", lambda cache: None)
+    releasing.bump_all(str(repo_packages), str(arr), "stable/rocky")
+
+    assert len(queries) == 1
+    assert releasing.index_repos_file(str(repo_packages / "nova.yml"))["nova"][
+        "sha"
+    ] == resolved
+    _, _, all_roles = releasing.sort_roles(str(arr))
+    assert all_roles[0]["version"] == resolved
+    assert copied == ["first.yaml"]
+
+
 # def test_ansible_role_requirements_file:
 #    pass
 
@@ -123,9 +452,107 @@ def test_get_sha_from_ref():
 
 # def test_find_release_number():
 #    pass
-#
-# def next_release_number():
-#    pass
+
+
+def _commit_version_file(repo, branch, path, version):
+    """ Creates a commit containing only a version file on branch """
+    blob = Blob.from_string(
+        "---\nopenstack_release: {}\n".format(version).encode("utf-8")
+    )
+    trees = []
+    parts = path.split("/")
+    tree = Tree()
+    tree.add(parts[-1].encode("utf-8"), 0o100644, blob.id)
+    trees.append(tree)
+    for part in reversed(parts[:-1]):
+        parent = Tree()
+        parent.add(part.encode("utf-8"), 0o040000, tree.id)
+        trees.append(parent)
+        tree = parent
+    commit = Commit()
+    commit.tree = tree.id
+    commit.author = commit.committer = b"Test <test@example.com>"
+    commit.author_time = commit.commit_time = 0
+    commit.author_timezone = commit.commit_timezone = 0
+    commit.message = b"Release"
+    repo.object_store.add_object(blob)
+    for tree in trees:
+        repo.object_store.add_object(tree)
+    repo.object_store.add_object(commit)
+    repo.refs[b"refs/heads/" + branch.encode("utf-8")] = commit.id
+
+
+def test_find_release_number_from_ref(tmp_path):
+    repo = Repo.init(str(tmp_path))
+    _commit_version_file(repo, "master", "inventory/group_vars/all/all.yml", "19.0.0.0b1")
+    _commit_version_file(repo, "stable/rocky", "group_vars/all/all.yml", "18.1.2")
+    assert releasing.find_release_number_from_ref(repo, "stable/rocky") == (
+        "18.1.2",
+        "group_vars/all/all.yml",
+    )
+    assert releasing.find_release_number_from_ref(repo, "refs/heads/master") == (
+        "19.0.0.0b1",
+        "inventory/group_vars/all/all.yml",
+    )
+
+
+def test_find_release_numbers(tmp_path):
+    repo = Repo.init(str(tmp_path))
+    _commit_version_file(repo, "master", "inventory/group_vars/all/all.yml", "19.0.0.0b1")
+    _commit_version_file(repo, "stable/rocky", "group_vars/all/all.yml", "18.1.2")
+    results = releasing.find_release_numbers([str(tmp_path)])
+    assert [result["ref"] for result in results] == ["master", "stable/rocky"]
+    assert results[0]["milestone"] == "19.0.0.0b2"
+    assert results[0]["rc"] == "19.0.0.0rc1"
+    assert results[1]["bugfix"] == "18.1.3"
+    assert results[1]["feature"] == "18.2.0"
+    assert results[1]["rc"] is None
+    assert results[1]["error"] is None
+
+
+def test_find_release_numbers_errors(tmp_path):
+    repo = Repo.init(str(tmp_path))
+    _commit_version_file(repo, "stable/rocky", "group_vars/all/all.yml", "18.1.2")
+    _commit_version_file(repo, "feature", "README.rst", "18.1.2")
+    # group_vars is a file, not a folder
+    _commit_version_file(repo, "blob", "group_vars", "18.1.2")
+    _commit_version_file(repo, "invalid", "group_vars/all/all.yml", "[18.1.2")
+    results = releasing.find_release_numbers(
+        [str(tmp_path)],
+        references=["feature", "unknown", "blob", "invalid", "stable/rocky"],
+    )
+    assert [result["current"] for result in results] == [
+        None, None, None, None, "18.1.2"
+    ]
+    assert results[0]["error"].startswith("No file found")
+    assert results[1]["error"].startswith("Reference unknown not found")
+    assert results[2]["error"].startswith("No file found")
+    assert "while parsing a flow sequence" in results[3]["error"]
+    assert results[0]["bugfix"] is None
+
+
+def test_find_release_numbers_remote_branches(tmp_path):
+    repo = Repo.init(str(tmp_path))
+    _commit_version_file(repo, "master", "group_vars/all/all.yml", "19.0.0.0b1")
+    _commit_version_file(repo, "stable/rocky", "group_vars/all/all.yml", "18.1.2")
+    # A fresh clone only has the remote stable branches
+    for branch in (b"master", b"stable/rocky"):
+        repo.refs[b"refs/remotes/origin/" + branch] = repo.refs[b"refs/heads/" + branch]
+    del repo.refs[b"refs/heads/stable/rocky"]
+    repo.refs.set_symbolic_ref(
+        b"refs/remotes/origin/HEAD", b"refs/remotes/origin/master"
+    )
+    results = releasing.find_release_numbers([str(tmp_path)])
+    assert [result["ref"] for result in results] == ["master", "stable/rocky"]
+    assert results[1]["current"] == "18.1.2"
+
+
+def test_next_release_number():
+    assert releasing.next_release_number("18.1.2", "bugfix") == ["18", "1", "3"]
+    assert releasing.next_release_number("18.1.2", "feature") == ["18", "2", "0"]
+    assert releasing.next_release_number("18.1.2", "milestone") == [
+        "19", "0", "0", "0b1"
+    ]
 
 # def update_release_number():
 #    pass